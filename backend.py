@@ -1,16 +1,41 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
+from collections import deque
 from datetime import datetime
+import threading
+
+try:
+    import orjson
+
+    def dumps(obj):
+        return orjson.dumps(obj)
+except ImportError:
+    import json
+
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
 
 app = Flask(__name__)
 CORS(app)
 
-# In-memory chat history (list of dicts)
-chat_history = []
+# In-memory chat history (most recent messages only)
+HISTORY_MAX_MESSAGES = 1000
+chat_history = deque(maxlen=HISTORY_MAX_MESSAGES)
+
+# /history is served from a cached serialization, rebuilt only after new messages
+history_lock = threading.Lock()
+history_json_cache = dumps({'history': []})
+history_dirty = False
 
 def get_timestamp():
     return datetime.now().strftime('%H:%M')
 
+def append_history(message):
+    global history_dirty
+    with history_lock:
+        chat_history.append(message)
+        history_dirty = True
+
 @app.route('/chat', methods=['POST'])
 def chat():
     data = request.json
@@ -18,15 +43,21 @@ def chat():
     if not user_msg:
         return jsonify({'error': 'No message provided'}), 400
     # Save user message
-    chat_history.append({'sender': 'user', 'text': user_msg, 'timestamp': get_timestamp()})
+    append_history({'sender': 'user', 'text': user_msg, 'timestamp': get_timestamp()})
     # Generate bot reply (replace with your real bot logic)
     bot_reply = f"You said: {user_msg}"
-    chat_history.append({'sender': 'bot', 'text': bot_reply, 'timestamp': get_timestamp()})
+    append_history({'sender': 'bot', 'text': bot_reply, 'timestamp': get_timestamp()})
     return jsonify({'reply': bot_reply})
 
 @app.route('/history', methods=['GET'])
 def history():
-    return jsonify({'history': chat_history})
+    global history_json_cache, history_dirty
+    with history_lock:
+        if history_dirty:
+            history_json_cache = dumps({'history': list(chat_history)})
+            history_dirty = False
+        body = history_json_cache
+    return app.response_class(body, mimetype='application/json')
 
 if __name__ == '__main__':
-    app.run(debug=True) 
\ No newline at end of file
+    app.run(debug=True)
\ No newline at end of file
@@ -4,18 +4,288 @@ try:
     sys.modules["sqlite3"] = pysqlite3
 except ImportError:
     pass
+try:
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+except ImportError:
+    ORTModelForFeatureExtraction = None
+try:
+    import faiss
+except ImportError:
+    faiss = None
+try:
+    import tokenizers
+except ImportError:
+    tokenizers = None
 import sentence_transformers
+import functools
+import hashlib
+import io
+import json
 import os
+import sqlite3
+import threading
+import urllib.request
+import numpy as np
 import chromadb
 import cohere
-from chromadb.utils import embedding_functions
+import torch
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import List, Dict, Iterator, Optional
 import logging
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+ONNX_MODEL_DIR = "minilm-int8"
+READ_WORKERS = 8
+QUERY_EMBEDDING_CACHE_SIZE = 256
+# Token counts are memoized by content hash, so the cache holds no document text
+TOKEN_COUNT_CACHE_SIZE = 1024
+TOKENIZER_DOWNLOAD_TIMEOUT = 10
+
+# FAISS switches from exact search to IVF-PQ for collections at least this large
+IVFPQ_MIN_VECTORS = 1_000_000
+IVFPQ_SUBQUANTIZERS = 16
+IVF_NPROBE = 16
+# VECTOR_QUANTIZATION values that map to a FAISS scalar quantizer; anything else keeps fp32
+SCALAR_QUANTIZERS = {"fp16": "QT_fp16", "int8": "QT_8bit"}
+
+# Greetings and acknowledgements answered without retrieval or generation
+SMALL_TALK_REPLIES = {
+    "hi": "Hello! How can I help you today?",
+    "hello": "Hello! How can I help you today?",
+    "hey": "Hello! How can I help you today?",
+    "thanks": "You're welcome! Anything else I can help with?",
+    "thank you": "You're welcome! Anything else I can help with?",
+    "ok": "Great! Let me know if you have another question.",
+    "bye": "Goodbye!",
+}
+
+# Static instruction block; only the context and query change per turn
+PROMPT_TEMPLATE = (
+    "Use the following HCL internal context and web knowledge if needed to answer the question:\n\n"
+    "Context:\n{context}\n\n"
+    "User Query: {query}\n\n"
+    "Answer:"
+)
+
+# Above either limit the retrieved context is assembled with io.StringIO
+LARGE_CONTEXT_DOCS = 20
+LARGE_CONTEXT_CHARS = 100_000
+
+COHERE_GENERATION_PARAMS = {
+    "model": "command-r-plus",
+    "max_tokens": 300,
+    "temperature": 0.3,
+    "stop_sequences": ["--END--"],
+    # Local context is packed to CONTEXT_TOKEN_BUDGET client-side, but web-search results are not
+    # measured, so Cohere may still trim an overflowing prompt (keeping document order)
+    "prompt_truncation": "AUTO_PRESERVE_ORDER",
+}
+# command-r-plus has a 128k-token window; the reserve covers the answer, instructions and web-search results
+MODEL_CONTEXT_TOKENS = 128_000
+RESERVED_TOKENS = 16_000
+CONTEXT_TOKEN_BUDGET = MODEL_CONTEXT_TOKENS - RESERVED_TOKENS
+# Fallback estimate when the Cohere tokenizer is unavailable
+CHARS_PER_TOKEN = 4
+WEB_SEARCH_CONNECTORS = [{"id": "web-search"}]
+
+class SemanticCache:
+    """
+    In-process cache of answers keyed by L2-normalized query embeddings.
+    A lookup returns the answer of the most similar cached query when its
+    cosine similarity is at least `tau`. Safe to share between threads.
+    """
+
+    def __init__(self, dim: int = 384, tau: float = 0.92, max_size: int = 1024):
+        self.tau = tau
+        self.max_size = max_size
+        # Fixed-capacity ring buffer; once full, the oldest entry is overwritten
+        self._cache_emb = np.empty((max_size, dim), dtype=np.float32)
+        self._cache_len = 0
+        self._next = 0
+        self.answers: List[Optional[str]] = [None] * max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        q = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(q)
+        return q / norm if norm > 0 else q
+
+    def lookup(self, embedding) -> Optional[str]:
+        query = self._normalize(embedding)
+        with self._lock:
+            if self._cache_len:
+                sims = self._cache_emb[:self._cache_len] @ query
+                i = int(np.argmax(sims))
+                if sims[i] >= self.tau:
+                    self.hits += 1
+                    return self.answers[i]
+            self.misses += 1
+            return None
+
+    def add(self, embedding, answer: str) -> None:
+        normalized = self._normalize(embedding)
+        with self._lock:
+            # Claim the slot once so the embedding and answer always land together
+            slot = self._next
+            self._next = (slot + 1) % self.max_size
+            self._cache_emb[slot] = normalized
+            self.answers[slot] = answer
+            self._cache_len = min(self._cache_len + 1, self.max_size)
+
+
+class FAISSVectorStore:
+    """
+    FAISS inner-product index over L2-normalized embeddings (so scores are
+    cosine similarities), persisted with `faiss.write_index` next to a SQLite
+    side table that holds each vector's ID, text and metadata. Vectors are
+    stored as fp32, fp16 or int8 codes depending on `quantization`.
+    """
+
+    def __init__(self, index_path: Path, docs_path: Path, quantization: str = "int8"):
+        self.index_path = index_path
+        self.docs_path = docs_path
+        self.quantization = quantization
+        self.index = None
+        self.ids: List[str] = []
+        self.documents: List[str] = []
+        self.metadatas: List[Dict] = []
+
+    @property
+    def count(self) -> int:
+        return self.index.ntotal if self.index is not None else 0
+
+    def exists(self) -> bool:
+        return self.index_path.exists() and self.docs_path.exists()
+
+    def load(self) -> None:
+        self.index = faiss.read_index(str(self.index_path))
+        if hasattr(self.index, "nprobe"):
+            self.index.nprobe = IVF_NPROBE
+        conn = sqlite3.connect(self.docs_path)
+        try:
+            rows = conn.execute("SELECT id, content, metadata FROM docs ORDER BY pos").fetchall()
+        finally:
+            conn.close()
+        self.ids = [row[0] for row in rows]
+        self.documents = [row[1] for row in rows]
+        self.metadatas = [json.loads(row[2]) for row in rows]
+
+    def build(self, ids: List[str], embeddings, documents: List[str], metadatas: List[Dict]) -> None:
+        vectors = np.ascontiguousarray(np.asarray(embeddings, dtype=np.float32).reshape(len(ids), -1))
+        faiss.normalize_L2(vectors)
+        dim = vectors.shape[1]
+
+        if len(ids) >= IVFPQ_MIN_VECTORS:
+            # Exact search stops paying off at this size; use a compressed inverted-file index
+            nlist = int(np.sqrt(len(ids)))
+            index = faiss.IndexIVFPQ(faiss.IndexFlatIP(dim), dim, nlist, IVFPQ_SUBQUANTIZERS, 8, faiss.METRIC_INNER_PRODUCT)
+            index.train(vectors)
+            index.nprobe = IVF_NPROBE
+        elif self.quantization in SCALAR_QUANTIZERS:
+            # Per-dimension ranges are trained on the corpus; queries stay fp32
+            qtype = getattr(faiss.ScalarQuantizer, SCALAR_QUANTIZERS[self.quantization])
+            index = faiss.IndexScalarQuantizer(dim, qtype, faiss.METRIC_INNER_PRODUCT)
+            index.train(vectors)
+        else:
+            index = faiss.IndexFlatIP(dim)
+        index.add(vectors)
+        faiss.write_index(index, str(self.index_path))
+
+        conn = sqlite3.connect(self.docs_path)
+        try:
+            conn.execute("DROP TABLE IF EXISTS docs")
+            conn.execute("CREATE TABLE docs (pos INTEGER PRIMARY KEY, id TEXT, content TEXT, metadata TEXT)")
+            conn.executemany(
+                "INSERT INTO docs VALUES (?, ?, ?, ?)",
+                [(pos, doc_id, content, json.dumps(metadata or {})) for pos, (doc_id, content, metadata) in enumerate(zip(ids, documents, metadatas))]
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+        self.index = index
+        self.ids = list(ids)
+        self.documents = list(documents)
+        self.metadatas = [metadata or {} for metadata in metadatas]
+
+    def search(self, query_embedding, k: int) -> List[Dict]:
+        query = np.asarray(query_embedding, dtype=np.float32).reshape(1, -1)
+        scores, positions = self.index.search(query, k)
+        # Distances are reported as cosine distance, matching ChromaDB's "cosine" space
+        return [
+            {"content": self.documents[pos], "metadata": self.metadatas[pos], "distance": 1.0 - float(score)}
+            for pos, score in zip(positions[0], scores[0])
+            if pos >= 0
+        ]
+
+
+class QuantizedMiniLM:
+    """
+    int8 ONNX Runtime export of all-MiniLM-L6-v2 with the same mean pooling
+    as the SentenceTransformer model. Mirrors the subset of
+    `SentenceTransformer.encode` used by the chatbot.
+    """
+
+    def __init__(self, model_dir: str = ONNX_MODEL_DIR, max_length: int = 256):
+        model_path = Path(model_dir)
+        if not (model_path / "model_quantized.onnx").exists():
+            logging.info(f"Exporting and quantizing {EMBEDDING_MODEL} to {model_path}...")
+            fp32_model = ORTModelForFeatureExtraction.from_pretrained(f"sentence-transformers/{EMBEDDING_MODEL}", export=True)
+            quantizer = ORTQuantizer.from_pretrained(fp32_model)
+            qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+            quantizer.quantize(save_dir=model_path, quantization_config=qconfig)
+            AutoTokenizer.from_pretrained(f"sentence-transformers/{EMBEDDING_MODEL}").save_pretrained(model_path)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_path, file_name="model_quantized.onnx", provider="CPUExecutionProvider"
+        )
+        self.max_length = max_length
+
+    def encode(self, sentences, batch_size: int = 64, normalize_embeddings: bool = True,
+               convert_to_numpy: bool = True, show_progress_bar: bool = False) -> np.ndarray:
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            tokens = self.tokenizer(
+                texts[start:start + batch_size], padding=True, truncation=True,
+                max_length=self.max_length, return_tensors="np"
+            )
+            hidden = self.model(**tokens).last_hidden_state
+            mask = tokens["attention_mask"][..., None].astype(np.float32)
+            batches.append((hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None))
+
+        embeddings = np.concatenate(batches).astype(np.float32) if batches else np.empty((0, 384), dtype=np.float32)
+        if normalize_embeddings:
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings[0] if single else embeddings
+
+
+def load_embedder():
+    """
+    Loads the MiniLM encoder: FP32 SentenceTransformer on GPU, the int8 ONNX
+    export on CPU when optimum is installed, FP32 on CPU otherwise.
+    """
+    if torch.cuda.is_available():
+        return sentence_transformers.SentenceTransformer(EMBEDDING_MODEL, device="cuda")
+    if ORTModelForFeatureExtraction is not None:
+        try:
+            return QuantizedMiniLM()
+        except Exception as e:
+            logging.warning(f"Could not load int8 ONNX embedder, falling back to SentenceTransformer: {e}")
+    return sentence_transformers.SentenceTransformer(EMBEDDING_MODEL, device="cpu")
+
 
 class HCLChatbot:
     """
@@ -23,22 +293,49 @@ class HCLChatbot:
     and Cohere for generation, with web search capabilities.
     """
 
-    def __init__(self, data_folder: str = "data", db_path: str = "chroma_db", collection_name: str = "hcl_docs_web", cohere_api_key: Optional[str] = None):
+    def __init__(self, data_folder: str = "data", db_path: str = "chroma_db", collection_name: str = "hcl_docs_web", cohere_api_key: Optional[str] = None,
+                 cache_tau: float = 0.92, cache_max_size: int = 1024, batch_size: int = 128,
+                 hnsw_m: int = 8, hnsw_construction_ef: int = 100, hnsw_search_ef: int = 32,
+                 embedder=None, cohere_client: Optional[cohere.Client] = None):
         self.data_folder = Path(data_folder)
         self.db_path = db_path
         self.collection_name = collection_name
+        self.batch_size = batch_size
+        # HNSW settings are fixed when a collection is created; raise them for larger corpora
+        self.hnsw_metadata = {
+            "hnsw:space": "cosine",
+            "hnsw:M": hnsw_m,
+            "hnsw:construction_ef": hnsw_construction_ef,
+            "hnsw:search_ef": hnsw_search_ef,
+        }
         self.documents = []
+        # "faiss" serves retrieval from an in-process index; "chroma" queries the collection directly
+        self.vector_backend = os.getenv("VECTOR_BACKEND", "faiss").lower()
+        self.vector_quantization = os.getenv("VECTOR_QUANTIZATION", "int8").lower()
+        self.vector_store = None
 
         # Use the argument if provided; fallback to environment variable
         self.cohere_api_key = cohere_api_key or os.getenv("COHERE_API_KEY")
         if not self.cohere_api_key:
             raise ValueError("COHERE_API_KEY not provided via argument or environment.")
 
-        self.cohere_client = cohere.Client(self.cohere_api_key)
+        # Callers such as the Streamlit app can inject process-wide shared clients and models
+        self.cohere_client = cohere_client or cohere.Client(self.cohere_api_key)
+
+        # Embeds documents at ingestion and queries for retrieval and the semantic cache
+        self.embedder = embedder or load_embedder()
+        # Per-instance memo so a prompt seen again (retrieval, cache, reruns) is embedded once
+        self.embed_query = functools.lru_cache(maxsize=QUERY_EMBEDDING_CACHE_SIZE)(self.embed_query)
+        # Fetched once here (or found unavailable once) rather than on the query path
+        self.tokenizer = self._load_tokenizer()
+        self._token_counts: Dict[bytes, int] = {}
+        self.semantic_cache = SemanticCache(tau=cache_tau, max_size=cache_max_size)
 
         # Load data and initialize ChromaDB
         self._load_data()
         self._initialize_chroma()
+        # Computed once so per-query checks don't touch the collection
+        self.has_local_docs: bool = self.collection is not None and self.collection.count() > 0
 
     def _load_data(self) -> None:
         logging.info(f"Looking for data in: {self.data_folder}")
@@ -46,26 +343,38 @@ class HCLChatbot:
             logging.warning(f"Data folder not found: {self.data_folder}. No local documents will be loaded.")
             return
 
-        loaded_count = 0
-        for file_name in os.listdir(self.data_folder):
-            if file_name.endswith(".txt"):
-                file_path = self.data_folder / file_name
-                try:
-                    with open(file_path, "r", encoding="utf-8") as f:
-                        content = f.read()
-                        if content.strip():
-                            self.documents.append({"content": content, "id": file_name})
-                            loaded_count += 1
-                        else:
-                            logging.warning(f"Skipping empty file: {file_name}")
-                except Exception as e:
-                    logging.error(f"Error reading file {file_name}: {e}")
+        with os.scandir(self.data_folder) as it:
+            entries = [e for e in it if e.is_file() and e.name.endswith(".txt")]
+
+        # File reads release the GIL, so a small thread pool overlaps I/O on large corpora
+        with ThreadPoolExecutor(max_workers=READ_WORKERS) as executor:
+            contents = list(executor.map(self._read_file, entries))
+
+        self.documents = [
+            {"content": content, "id": entry.name, "doc_id": hashlib.sha256(content.encode("utf-8")).hexdigest()}
+            for entry, content in zip(entries, contents)
+            if content is not None
+        ]
+        loaded_count = len(self.documents)
 
         if loaded_count == 0:
             logging.warning(f"No .txt documents were successfully loaded from {self.data_folder}.")
         else:
             logging.info(f"Loaded {loaded_count} text files from {self.data_folder}")
 
+    @staticmethod
+    def _read_file(entry: os.DirEntry) -> Optional[str]:
+        try:
+            with open(entry.path, "r", encoding="utf-8", buffering=1 << 20) as f:
+                content = f.read()
+        except Exception as e:
+            logging.error(f"Error reading file {entry.name}: {e}")
+            return None
+        if not content.strip():
+            logging.warning(f"Skipping empty file: {entry.name}")
+            return None
+        return content
+
     def _initialize_chroma(self) -> None:
         if not self.documents:
             logging.info("No local documents loaded, skipping ChromaDB initialization.")
@@ -75,52 +384,141 @@ class HCLChatbot:
         logging.info("Initializing ChromaDB...")
         try:
             self.chroma_client = chromadb.PersistentClient(path=self.db_path)
-            self.embedding_func = embedding_functions.SentenceTransformerEmbeddingFunction(
-                model_name="all-MiniLM-L6-v2"
-            )
+            # Every add and query supplies vectors, so the collection needs no embedding function
+            # (and opening it with one would conflict with the one recorded in older collections)
             self.collection = self.chroma_client.get_or_create_collection(
                 name=self.collection_name,
-                embedding_function=self.embedding_func,
-                metadata={"hnsw:space": "cosine"}
+                embedding_function=None,
+                metadata=self.hnsw_metadata
             )
 
-            current_ids_in_db = self.collection.get(include=[])['ids']
-            existing_doc_ids_in_db = set(current_ids_in_db)
-
-            new_documents_to_add = []
-            new_metadatas_to_add = []
-            new_ids_to_add = []
-
-            for i, doc in enumerate(self.documents):
-                doc_id = f"{i}_{doc['id']}"
-                if doc_id not in existing_doc_ids_in_db:
-                    new_documents_to_add.append(doc["content"])
-                    new_metadatas_to_add.append({"source_type": "local_document", "source_name": doc["id"]})
-                    new_ids_to_add.append(doc_id)
+            # Files with identical content share an ID; keep the first one
+            candidates = {}
+            for doc in self.documents:
+                candidates.setdefault(doc["doc_id"], doc)
+
+            # The manifest records ingested IDs so restarts don't have to query the collection;
+            # it is rebuilt from the collection whenever the two disagree on size
+            collection_count = self.collection.count()
+            manifest = self._open_manifest()
+            existing_doc_ids_in_db = {row[0] for row in manifest.execute("SELECT id FROM ids")} if manifest is not None else set()
+            if manifest is None or len(existing_doc_ids_in_db) != collection_count:
+                existing_doc_ids_in_db = set(self.collection.get(include=[])['ids'])
+                manifest = manifest or self._open_manifest(create=True)
+                manifest.execute("DELETE FROM ids")
+                manifest.executemany("INSERT OR IGNORE INTO ids VALUES (?)", [(i,) for i in existing_doc_ids_in_db])
+                manifest.commit()
+
+            # IDs of edited or removed files (and older filename-based IDs) no longer match a file
+            stale_ids = list(existing_doc_ids_in_db - candidates.keys())
+            if stale_ids:
+                logging.info(f"Removing {len(stale_ids)} stale documents from ChromaDB...")
+                for start in range(0, len(stale_ids), self.batch_size):
+                    batch = stale_ids[start:start + self.batch_size]
+                    self.collection.delete(ids=batch)
+                    manifest.executemany("DELETE FROM ids WHERE id = ?", [(i,) for i in batch])
+                    manifest.commit()
+
+            new_docs = [(doc_id, doc) for doc_id, doc in candidates.items() if doc_id not in existing_doc_ids_in_db]
+            new_ids_to_add = [doc_id for doc_id, _ in new_docs]
+            new_documents_to_add = [doc["content"] for _, doc in new_docs]
+            new_metadatas_to_add = [{"source_type": "local_document", "source_name": doc["id"]} for _, doc in new_docs]
 
             if new_ids_to_add:
                 logging.info(f"Adding {len(new_ids_to_add)} new documents to ChromaDB...")
-                self.collection.add(
-                    documents=new_documents_to_add,
-                    metadatas=new_metadatas_to_add,
-                    ids=new_ids_to_add
+                new_embeddings_to_add = self.embedder.encode(
+                    new_documents_to_add,
+                    batch_size=64,
+                    normalize_embeddings=True,
+                    convert_to_numpy=True,
+                    show_progress_bar=True
                 )
+                for start in range(0, len(new_ids_to_add), self.batch_size):
+                    end = start + self.batch_size
+                    self.collection.add(
+                        embeddings=new_embeddings_to_add[start:end],
+                        documents=new_documents_to_add[start:end],
+                        metadatas=new_metadatas_to_add[start:end],
+                        ids=new_ids_to_add[start:end]
+                    )
+                    manifest.executemany("INSERT OR IGNORE INTO ids VALUES (?)", [(i,) for i in new_ids_to_add[start:end]])
+                    manifest.commit()
+                    logging.info(f"Added batch {min(end, len(new_ids_to_add))}/{len(new_ids_to_add)} to ChromaDB.")
                 logging.info(f"Successfully added {len(new_ids_to_add)} documents to ChromaDB.")
             else:
                 logging.info("ChromaDB collection is already up-to-date.")
+            manifest.close()
 
         except Exception as e:
             logging.error(f"Error initializing ChromaDB: {e}")
             self.collection = None
+            return
 
-    def retrieve_local_documents(self, query: str, k: int = 3) -> List[Dict]:
-        if not self.collection:
+        self._load_faiss_index(set(candidates), rebuild=bool(new_ids_to_add or stale_ids))
+
+    def _load_faiss_index(self, expected_ids: set, rebuild: bool) -> None:
+        if self.vector_backend != "faiss":
+            return
+        if faiss is None:
+            logging.info("faiss is not installed; retrieval will query ChromaDB directly.")
+            return
+
+        store = FAISSVectorStore(
+            Path(self.db_path) / f"{self.collection_name}.{self.vector_quantization}.faiss",
+            Path(self.db_path) / f"{self.collection_name}.{self.vector_quantization}.faiss_docs.sqlite",
+            quantization=self.vector_quantization
+        )
+        try:
+            if not rebuild and store.exists():
+                store.load()
+                # A matching count is not enough: an edit made through another backend, a crash before the
+                # last rebuild or an old index for this quantization can hold the same number of other IDs
+                rebuild = store.count != len(store.ids) or set(store.ids) != expected_ids
+            else:
+                rebuild = True
+
+            if rebuild:
+                logging.info("Building FAISS index from ChromaDB embeddings...")
+                data = self.collection.get(include=["embeddings", "documents", "metadatas"])
+                store.build(data["ids"], data["embeddings"], data["documents"], data["metadatas"])
+
+            self.vector_store = store
+            logging.info(f"FAISS index ready with {store.count} vectors.")
+        except Exception as e:
+            logging.error(f"Error loading FAISS index, falling back to ChromaDB queries: {e}")
+            self.vector_store = None
+
+    def _open_manifest(self, create: bool = False) -> Optional[sqlite3.Connection]:
+        manifest_path = Path(self.db_path) / f"{self.collection_name}_ingested_ids.sqlite"
+        if not create and not manifest_path.exists():
+            return None
+        conn = sqlite3.connect(manifest_path)
+        conn.execute("CREATE TABLE IF NOT EXISTS ids (id TEXT PRIMARY KEY)")
+        return conn
+
+    def embed_query(self, query: str) -> np.ndarray:
+        embedding = self.embedder.encode(query, normalize_embeddings=True, convert_to_numpy=True)
+        # Results are memoized and shared between callers, so they must not be modified in place
+        embedding.setflags(write=False)
+        return embedding
+
+    def retrieve_local_documents(self, query: str, k: int = 3, query_embedding: Optional[np.ndarray] = None) -> List[Dict]:
+        if not self.has_local_docs:
             logging.info("No ChromaDB collection available.")
             return []
 
         try:
+            if query_embedding is None:
+                query_embedding = self.embed_query(query)
+            if self.vector_store is not None:
+                retrieved_docs = self.vector_store.search(query_embedding, k)
+                if retrieved_docs:
+                    logging.info(f"Retrieved {len(retrieved_docs)} documents.")
+                else:
+                    logging.warning("No matching documents found.")
+                return retrieved_docs
             results = self.collection.query(
-                query_texts=[query],
+                query_embeddings=[query_embedding.tolist()],
                 n_results=k,
                 include=["documents", "metadatas", "distances"]
             )
@@ -141,33 +539,131 @@ class HCLChatbot:
             logging.error(f"Error retrieving documents from ChromaDB: {e}")
             return []
 
-    def generate_with_cohere(self, query: str, prompt: str, documents: Optional[List[str]] = None) -> str:
+    def _chat(self, prompt: str):
+        return self.cohere_client.chat(message=prompt, connectors=WEB_SEARCH_CONNECTORS, **COHERE_GENERATION_PARAMS)
+
+    def _lookup_cache(self, user_query: str, query_embedding: Optional[np.ndarray]):
         try:
-            response = self.cohere_client.generate(
-                model="command-r-plus",
-                prompt=prompt,
-                max_tokens=300,
-                temperature=0.3,
-                stop_sequences=["--END--"]
-            )
-            return response.generations[0].text.strip()
+            if query_embedding is None:
+                query_embedding = self.embed_query(user_query)
+            cached_answer = self.semantic_cache.lookup(query_embedding)
+            if cached_answer is not None:
+                logging.info(f"Semantic cache hit (hits={self.semantic_cache.hits}, misses={self.semantic_cache.misses}).")
+            return query_embedding, cached_answer
+        except Exception as e:
+            logging.error(f"Error checking semantic cache: {e}")
+            return None, None
+
+    @staticmethod
+    def _build_context(local_docs: List[Dict]) -> str:
+        if len(local_docs) <= LARGE_CONTEXT_DOCS and sum(len(doc["content"]) for doc in local_docs) <= LARGE_CONTEXT_CHARS:
+            return "\n\n".join(doc["content"] for doc in local_docs)
+
+        # Large contexts are streamed into one buffer to avoid holding the pieces and the result at once
+        buf = io.StringIO()
+        for i, doc in enumerate(local_docs):
+            if i:
+                buf.write("\n\n")
+            buf.write(doc["content"])
+        return buf.getvalue()
+
+    def _load_tokenizer(self):
+        if tokenizers is None:
+            logging.warning(f"tokenizers is not installed; estimating {CHARS_PER_TOKEN} characters per token.")
+            return None
+        try:
+            tokenizer_url = self.cohere_client.models.get(COHERE_GENERATION_PARAMS["model"]).tokenizer_url
+            with urllib.request.urlopen(tokenizer_url, timeout=TOKENIZER_DOWNLOAD_TIMEOUT) as response:
+                return tokenizers.Tokenizer.from_str(response.read().decode("utf-8"))
+        except Exception as e:
+            logging.warning(f"Could not load the Cohere tokenizer, estimating {CHARS_PER_TOKEN} characters per token: {e}")
+            return None
+
+    def _count_tokens(self, text: str) -> int:
+        key = hashlib.sha256(text.encode("utf-8")).digest()
+        count = self._token_counts.get(key)
+        if count is None:
+            if self.tokenizer is not None:
+                count = len(self.tokenizer.encode(text, add_special_tokens=False).ids)
+            else:
+                count = len(text) // CHARS_PER_TOKEN + 1
+            if len(self._token_counts) >= TOKEN_COUNT_CACHE_SIZE:
+                # Evict the oldest entry (dicts keep insertion order)
+                self._token_counts.pop(next(iter(self._token_counts)), None)
+            self._token_counts[key] = count
+        return count
+
+    def _fit_to_budget(self, local_docs: List[Dict]) -> List[Dict]:
+        # Keep the highest-ranked documents that fit; drop the rest
+        packed, used = [], 0
+        for doc in local_docs:
+            used += self._count_tokens(doc["content"])
+            if used > CONTEXT_TOKEN_BUDGET:
+                logging.info(f"Dropped {len(local_docs) - len(packed)} documents exceeding the context budget.")
+                break
+            packed.append(doc)
+        return packed
+
+    def _build_prompt(self, user_query: str, local_docs: List[Dict]) -> str:
+        context = self._build_context(self._fit_to_budget(local_docs))
+        return PROMPT_TEMPLATE.format_map({"context": context, "query": user_query})
+
+    def generate_final_response(self, user_query: str, local_docs: List[Dict], query_embedding: Optional[np.ndarray] = None) -> str:
+        query_embedding, cached_answer = self._lookup_cache(user_query, query_embedding)
+        if cached_answer is not None:
+            return cached_answer
+
+        try:
+            prompt = self._build_prompt(user_query, local_docs)
+        except Exception as e:
+            logging.error(f"Error building final prompt: {e}")
+            return "Sorry, something went wrong while preparing the answer."
+
+        try:
+            answer = self._chat(prompt).text.strip()
         except Exception as e:
             logging.error(f"Error generating response with Cohere: {str(e)}")
             return f"Sorry, an error occurred while generating a response: {str(e)}"
 
-    def generate_final_response(self, user_query: str, local_docs: List[Dict]) -> str:
+        if query_embedding is not None:
+            self.semantic_cache.add(query_embedding, answer)
+        return answer
+
+    def generate_final_response_stream(self, user_query: str, local_docs: List[Dict],
+                                       query_embedding: Optional[np.ndarray] = None) -> Iterator[str]:
+        """
+        Streaming variant of `generate_final_response`: yields answer text as
+        Cohere generates it.
+        """
+        query_embedding, cached_answer = self._lookup_cache(user_query, query_embedding)
+        if cached_answer is not None:
+            yield cached_answer
+            return
+
         try:
-            context_string = "\n\n".join([doc["content"] for doc in local_docs])
-            prompt = (
-                f"Use the following HCL internal context and web knowledge if needed to answer the question:\n\n"
-                f"Context:\n{context_string}\n\n"
-                f"User Query: {user_query}\n\n"
-                f"Answer:"
-            )
-            return self.generate_with_cohere(user_query, prompt)
+            prompt = self._build_prompt(user_query, local_docs)
         except Exception as e:
             logging.error(f"Error building final prompt: {e}")
-            return "Sorry, something went wrong while preparing the answer."
+            yield "Sorry, something went wrong while preparing the answer."
+            return
+
+        chunks = []
+        try:
+            for event in self.cohere_client.chat_stream(message=prompt, connectors=WEB_SEARCH_CONNECTORS, **COHERE_GENERATION_PARAMS):
+                if event.event_type == "text-generation":
+                    chunks.append(event.text)
+                    yield event.text
+        except Exception as e:
+            logging.error(f"Error streaming response from Cohere: {str(e)}")
+            yield f"Sorry, an error occurred while generating a response: {str(e)}"
+            return
+
+        if query_embedding is not None:
+            self.semantic_cache.add(query_embedding, "".join(chunks).strip())
+
+    @staticmethod
+    def _small_talk_reply(query: str) -> Optional[str]:
+        return SMALL_TALK_REPLIES.get(query.lower().strip(" !.?"))
 
     def chat_interface(self):
         print("\n==============================================")
@@ -185,9 +681,17 @@ class HCLChatbot:
                     print("\nAssistant: Goodbye!")
                     break
 
-                local_docs = self.retrieve_local_documents(user_input)
-                response = self.generate_final_response(user_input, local_docs)
-                print(f"\nAssistant: {response}\n")
+                small_talk = self._small_talk_reply(user_input)
+                if small_talk:
+                    print(f"\nAssistant: {small_talk}\n")
+                    continue
+
+                query_embedding = self.embed_query(user_input)
+                local_docs = self.retrieve_local_documents(user_input, query_embedding=query_embedding)
+                print("\nAssistant: ", end="", flush=True)
+                for chunk in self.generate_final_response_stream(user_input, local_docs, query_embedding=query_embedding):
+                    print(chunk, end="", flush=True)
+                print("\n")
 
             except KeyboardInterrupt:
                 print("\n\nAssistant: Session ended. Goodbye!")
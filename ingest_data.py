@@ -1,6 +1,10 @@
 import os
 import chromadb
-from chromadb.utils import embedding_functions
+from hcl_chatbot import load_embedder
+
+# Chroma add() calls are chunked; embeddings are computed up front in encoder-sized batches
+ADD_BATCH_SIZE = 5000
+ENCODE_BATCH_SIZE = 256
 
 def load_text_files(folder_path):
     docs = []
@@ -31,20 +35,35 @@ def load_text_files(folder_path):
 
 try:
     client = chromadb.PersistentClient(path="./chroma_db")
-    embedding_func = embedding_functions.SentenceTransformerEmbeddingFunction(
-        model_name="all-MiniLM-L6-v2"
-    )
-    collection = client.get_or_create_collection(
-        name="my_docs",
-        embedding_function=embedding_func
-    )
+    # Embeddings are always supplied up front, so the collection needs no embedding function
+    collection = client.get_or_create_collection(name="my_docs", embedding_function=None)
 
     docs, ids, metas = load_text_files("data")
+    existing_ids = set(collection.get(ids=ids, include=[])["ids"]) if ids else set()
+    new_rows = [(doc, doc_id, meta) for doc, doc_id, meta in zip(docs, ids, metas) if doc_id not in existing_ids]
 
     if len(docs) == 0:
         print("No documents found to add!")
+    elif not new_rows:
+        print(f"Collection 'my_docs' is already up-to-date ({collection.count()} documents).")
     else:
-        collection.add(documents=docs, ids=ids, metadatas=metas)
+        docs, ids, metas = (list(column) for column in zip(*new_rows))
+        # The encoder is only loaded when there is something to embed
+        embeddings = load_embedder().encode(
+            docs,
+            batch_size=ENCODE_BATCH_SIZE,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+        for start in range(0, len(docs), ADD_BATCH_SIZE):
+            end = start + ADD_BATCH_SIZE
+            collection.add(
+                ids=ids[start:end],
+                embeddings=embeddings[start:end],
+                documents=docs[start:end],
+                metadatas=metas[start:end]
+            )
         print(f"Added {len(docs)} documents to the ChromaDB collection 'my_docs'.")
 
 except Exception as e:
@@ -4,8 +4,14 @@ try:
     sys.modules["sqlite3"] = pysqlite3
 except ImportError:
     pass
+import json
+import logging
+import threading
+from pathlib import Path
+import cohere
 import streamlit as st
-from hcl_chatbot import HCLChatbot  # Import your chatbot class
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from hcl_chatbot import HCLChatbot, load_embedder  # Import your chatbot class
 
 # Set Streamlit page configuration FIRST
 st.set_page_config(page_title="HCL Internal Assistant", page_icon="🤖")
@@ -22,36 +28,105 @@ with st.sidebar:
                 st.markdown("---")
     else:
         st.info("No chat history yet.")
-    if st.button("Clear History"):
-        st.session_state.history = []
+    st.button("Clear History", on_click=lambda: st.session_state.update(history=[]))
+
+COLLECTION_NAME = "hcl_docs_web_v2"
+# session_state keeps only the most recent 50 messages (25 turns); each session's full transcript
+# goes to its own append-only spool, HISTORY_SPOOL_DIR/<session id>.jsonl
+MAX_SESSION_MESSAGES = 50
+HISTORY_SPOOL_DIR = Path.home() / ".hcl_chat_history"
+
+
+# --- Shared resources (loaded once per process, reused across sessions and reruns) ---
+@st.cache_resource
+def get_embedder():
+    return load_embedder()
+
+
+@st.cache_resource
+def get_cohere_client(key: str) -> cohere.Client:
+    return cohere.Client(key)
+
+
+@st.cache_resource(show_spinner=False)
+def get_chatbot(key: str, collection_name: str = COLLECTION_NAME) -> HCLChatbot:
+    return HCLChatbot(
+        data_folder="data",
+        collection_name=collection_name,
+        cohere_api_key=key,
+        embedder=get_embedder(),
+        cohere_client=get_cohere_client(key)
+    )
+
 
 # Fetch API key from Streamlit secrets
 api_key = st.secrets["COHERE_API_KEY"]
 
+
+# Build the shared chatbot in the background once per process, so the page renders while it loads
+@st.cache_resource
+def _start_warmup(key: str) -> threading.Thread:
+    thread = threading.Thread(target=get_chatbot, args=(key,), daemon=True, name="chatbot-warmup")
+    add_script_run_ctx(thread, get_script_run_ctx())
+    thread.start()
+    return thread
+
+
+warmup = _start_warmup(api_key)
+
+
+# Repeated prompts skip the ANN query; the collection name is part of the cache key.
+# The chatbot and the embedding (derived from the prompt) are left out of the key (leading underscore).
+@st.cache_data(ttl=3600, max_entries=512, show_spinner=False)
+def _cached_retrieve(prompt: str, collection_name: str, _chatbot: HCLChatbot, _query_embedding=None) -> list:
+    return _chatbot.retrieve_local_documents(prompt, query_embedding=_query_embedding)
+
+
+def _embed_and_retrieve(chatbot: HCLChatbot, prompt: str) -> tuple:
+    try:
+        query_embedding = chatbot.embed_query(prompt)
+    except Exception as e:
+        # Answer without local context rather than failing the page
+        logging.error(f"Error embedding query: {e}")
+        return None, []
+    local_docs = _cached_retrieve(prompt, chatbot.collection_name, chatbot, _query_embedding=query_embedding) if chatbot.has_local_docs else []
+    return query_embedding, local_docs
+
+
+def _record_message(role: str, content: str) -> None:
+    message = {"role": role, "content": content}
+    try:
+        HISTORY_SPOOL_DIR.mkdir(exist_ok=True)
+        with open(HISTORY_SPOOL_DIR / f"{get_script_run_ctx().session_id}.jsonl", "a", encoding="utf-8") as spool:
+            spool.write(json.dumps(message, separators=(",", ":")) + "\n")
+    except OSError as e:
+        logging.warning(f"Could not write chat history spool: {e}")
+    for key in ("messages", "history"):
+        st.session_state[key] = (st.session_state[key] + [message])[-MAX_SESSION_MESSAGES:]
+
+
 # --- Title and Description ---
 st.title("🤖 HCL Internal Assistant")
 st.markdown("Ask me anything about HCL internal documents or general queries. I can use both internal knowledge and web search.")
 
-# --- Initialize Chatbot (once per session) ---
-if "chatbot" not in st.session_state:
-    try:
-        st.session_state.chatbot = HCLChatbot(
-            data_folder="data",
-            collection_name="hcl_docs_web_v2",
-            cohere_api_key=api_key
-        )
-        st.success("Chatbot initialized successfully! Ready to chat.")
-    except ValueError as e:
-        st.error(f"Initialization Error: {e}. Please ensure COHERE_API_KEY is set in Streamlit secrets.")
-        st.stop()
-    except Exception as e:
-        st.error(f"An unexpected error occurred during chatbot initialization: {e}")
-        st.stop()
-else:
-    st.info("Chatbot is ready!")
+# --- Initialize Chatbot (once per process, shared by all sessions) ---
+if warmup.is_alive():
+    with st.spinner("Warming up the assistant..."):
+        warmup.join()
 
-# Access the chatbot instance
-chatbot = st.session_state.chatbot
+try:
+    chatbot = get_chatbot(api_key)
+except ValueError as e:
+    st.error(f"Initialization Error: {e}. Please ensure COHERE_API_KEY is set in Streamlit secrets.")
+    st.stop()
+except Exception as e:
+    st.error(f"An unexpected error occurred during chatbot initialization: {e}")
+    st.stop()
+
+# Announce readiness once per session rather than on every rerun
+if not st.session_state.setdefault("init_notified", False):
+    st.session_state.init_notified = True
+    st.success("Chatbot initialized successfully! Ready to chat.")
 
 # --- Chat History Display ---
 if "messages" not in st.session_state:
@@ -64,26 +139,22 @@ for message in st.session_state.messages:
 
 # --- User Input and Chat Logic ---
 if prompt := st.chat_input("What would you like to know?"):
-    st.session_state.messages.append({"role": "user", "content": prompt})
-    st.session_state.history.append({"role": "user", "content": prompt})
+    _record_message("user", prompt)
     with st.chat_message("user"):
         st.markdown(prompt)
 
     with st.chat_message("assistant"):
         with st.spinner("Thinking..."):
-            local_docs = []
-            if chatbot.collection:
-                local_docs = chatbot.retrieve_local_documents(prompt)
-            else:
+            # The embedding is shared between retrieval and the semantic cache
+            query_embedding, local_docs = _embed_and_retrieve(chatbot, prompt)
+            if not chatbot.has_local_docs:
                 st.info("No local documents loaded or ChromaDB not configured for local retrieval.")
 
-            response = chatbot.generate_final_response(prompt, local_docs)
-            st.markdown(response)
-        st.session_state.messages.append({"role": "assistant", "content": response})
-        st.session_state.history.append({"role": "assistant", "content": response})
+        # Render tokens as Cohere produces them; write_stream returns the full text
+        response = st.write_stream(chatbot.generate_final_response_stream(prompt, local_docs, query_embedding=query_embedding))
+        _record_message("assistant", response)
 
 # --- Optional: Clear Chat Button ---
-if st.button("Clear Chat"):
-    st.session_state.messages = []
-    st.rerun()
+# on_click runs before the script reruns, so the cleared state renders without a second rerun
+st.button("Clear Chat", on_click=lambda: st.session_state.update(messages=[]))
 